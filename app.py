@@ -1,6 +1,10 @@
+import os
+import uuid
+
 import streamlit as st
 from databricks.sdk import WorkspaceClient
 
+from chat_history_store import ChatHistoryStore
 from dbx_serving_client import DatabricksServingChatClient
 
 # ----------------------------
@@ -13,68 +17,130 @@ st.title("Simple Chat (Databricks Serving)")
 # Config
 # ----------------------------
 ENDPOINT_NAME = "kikkawa-samplechat-model"
+CHAT_DB_PATH = os.environ.get("CHAT_DB_PATH", "chat.db")
+CHAT_RETENTION_DAYS = float(os.environ.get("CHAT_RETENTION_DAYS", "30"))
 
 # Databricks client (Apps上では自動認証される想定)
-w = WorkspaceClient()
+# rerun ごと・セッションごとに作り直さず、プロセス内で1つを共有する
+@st.cache_resource
+def get_workspace() -> WorkspaceClient:
+    return WorkspaceClient()
+
 
 # Chat Client
-client = DatabricksServingChatClient(w, ENDPOINT_NAME)
+@st.cache_resource
+def get_chat_client(endpoint_name: str) -> DatabricksServingChatClient:
+    return DatabricksServingChatClient(get_workspace(), endpoint_name)
+
+
+client = get_chat_client(ENDPOINT_NAME)
+
+
+# Chat history store (SQLite)
+@st.cache_resource
+def get_history_store(db_path: str, retention_days: float) -> ChatHistoryStore:
+    return ChatHistoryStore(db_path, retention_sec=retention_days * 24 * 3600)
+
+
+store = get_history_store(CHAT_DB_PATH, CHAT_RETENTION_DAYS)
+
+# 履歴は認証済みユーザーごとに分ける (Databricks Apps はプロキシが X-Forwarded-Email を付与する)
+# ヘッダが無いのはローカル実行時のみ
+user_id = st.context.headers.get("X-Forwarded-Email") or "local"
+
+# Session id はURLのクエリパラメータに持たせ、リロード後も同じ履歴を復元する
+# (URLを他人が開いても、user_id が違えば別の履歴になる)
+sid = st.query_params.get("sid")
+if not sid:
+    sid = uuid.uuid4().hex
+    st.query_params["sid"] = sid
 
 # ----------------------------
 # Sidebar UI
 # ----------------------------
-with st.sidebar:
+# fragment 化して、スライダー等の操作でサイドバーだけを rerun させる
+# (チャット履歴の再描画を伴わない)。値は key 経由で session_state に残す
+@st.fragment
+def sidebar_settings():
     st.header("Settings")
     st.write("CHAT_ENDPOINT =", ENDPOINT_NAME or "(not set)")
 
-    system_prompt = st.text_area("System prompt", "You are a helpful assistant.", height=100)
-    temperature = st.slider("temperature", 0.0, 1.0, 0.2, 0.05)
-    max_tokens = st.slider("max_tokens", 64, 2048, 512, 64)
+    st.text_area("System prompt", "You are a helpful assistant.", height=100, key="system_prompt")
+    st.slider("temperature", 0.0, 1.0, 0.2, 0.05, key="temperature")
+    st.slider("max_tokens", 64, 2048, 512, 64, key="max_tokens")
 
-    debug = st.checkbox("Debug", value=False)
+    st.checkbox("Debug", value=False, key="debug")
 
     if st.button("Clear chat"):
-        st.session_state.messages = [{"role": "system", "content": system_prompt}]
+        st.session_state.messages = [{"role": "system", "content": st.session_state.system_prompt}]
+        st.session_state.history_summary = {}
+        store.save(user_id, sid, st.session_state.messages, st.session_state.history_summary)
         st.rerun()
 
+    if st.session_state.debug:
+        st.subheader("Debug info")
+        st.json(st.session_state.get("messages", [])[-6:])
+
+
+with st.sidebar:
+    sidebar_settings()
+
+system_prompt = st.session_state.system_prompt
+temperature = st.session_state.temperature
+max_tokens = st.session_state.max_tokens
+
 # ----------------------------
 # Chat state
 # ----------------------------
 if "messages" not in st.session_state:
-    st.session_state.messages = [{"role": "system", "content": system_prompt}]
-else:
-    # system promptは常に先頭に反映
-    st.session_state.messages[0] = {"role": "system", "content": system_prompt}
-
-# Show history (systemは表示しない)
-for m in st.session_state.messages:
-    if m["role"] == "system":
-        continue
-    with st.chat_message(m["role"]):
-        st.markdown(m["content"])
-
-if debug:
-    st.sidebar.subheader("Debug info")
-    st.sidebar.json(st.session_state.messages[-6:])
-
-# Input
-prompt = st.chat_input("Type a message")
-if prompt:
+    st.session_state.messages = store.load(user_id, sid) or [{"role": "system", "content": system_prompt}]
+    # 古い履歴の要約状態 (client._prune が更新する)。履歴と一緒に保存・復元する
+    st.session_state.history_summary = store.load_summary(user_id, sid) or {}
+# system promptは常に先頭に反映
+st.session_state.messages[0] = {"role": "system", "content": system_prompt}
+
+# ----------------------------
+# Chat UI
+# ----------------------------
+def render_history():
+    """履歴を表示する (systemは表示しない)"""
+    for m in st.session_state.messages:
+        if m["role"] == "system":
+            continue
+        with st.chat_message(m["role"]):
+            st.markdown(m["content"])
+
+
+def handle_input(prompt: str):
+    """ユーザー入力を履歴に追加し、応答をストリーム表示して保存する"""
     st.session_state.messages.append({"role": "user", "content": prompt})
     with st.chat_message("user"):
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            try:
-                reply = client.send_chat(
+        # トークンを受け取り次第表示する (体感待ち時間 = 最初のトークンまで)
+        try:
+            reply = st.write_stream(
+                client.send_chat_stream(
                     messages=st.session_state.messages,
                     temperature=temperature,
                     max_tokens=max_tokens,
+                    summary_state=st.session_state.history_summary,
                 )
-            except Exception as e:
-                reply = f"Error: {e}"
-
-        st.markdown(reply)
+            )
+        except Exception as e:
+            reply = f"Error: {e}"
+            st.markdown(reply)
 
     st.session_state.messages.append({"role": "assistant", "content": reply})
+    store.save(user_id, sid, st.session_state.messages, st.session_state.history_summary)
+
+
+# 入力処理は fragment にしない: fragment 単位の rerun では前回 fragment 内に描画した
+# 吹き出しが消えてしまうため、送信時はアプリ全体を rerun させる
+# (スライダー等の操作はサイドバーの fragment 内で完結する)
+render_history()
+
+prompt = st.chat_input("Type a message")
+if prompt:
+    handle_input(prompt)
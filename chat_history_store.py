@@ -0,0 +1,79 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, List, Dict, Optional
+
+class ChatHistoryStore:
+    """
+    チャット履歴を SQLite に保存し、リロード・再接続・再起動をまたいで復元するストア。
+    履歴は (ユーザー, セッションID) 単位で保持し、retention_sec より古いものは破棄する。
+    履歴の要約状態 (DatabricksServingChatClient の summary_state) も一緒に保存する。
+    """
+    def __init__(self, db_path: str = "chat.db", retention_sec: float = 30 * 24 * 3600):
+        self.db_path = db_path
+        self.retention_sec = retention_sec
+
+        # Streamlit はセッションごとに別スレッドで動くため、接続は共有しロックで直列化する
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_sessions("
+                "user TEXT NOT NULL, sid TEXT NOT NULL, messages TEXT NOT NULL, "
+                "summary TEXT NOT NULL DEFAULT '{}', updated REAL NOT NULL, "
+                "PRIMARY KEY (user, sid))"
+            )
+        self.purge_expired()
+
+    def load(self, user: str, sid: str) -> Optional[List[Dict[str, str]]]:
+        """保存済みの履歴を返す。無い・他ユーザーのもの・期限切れなら None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT messages FROM chat_sessions WHERE user = ? AND sid = ? AND updated >= ?",
+                (user, sid, time.time() - self.retention_sec),
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def load_summary(self, user: str, sid: str) -> Optional[Dict[str, Any]]:
+        """保存済みの要約状態を返す。無ければ None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary FROM chat_sessions WHERE user = ? AND sid = ? AND updated >= ?",
+                (user, sid, time.time() - self.retention_sec),
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save(
+        self,
+        user: str,
+        sid: str,
+        messages: List[Dict[str, str]],
+        summary_state: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """履歴 (と要約状態) を丸ごと上書き保存する"""
+        body = json.dumps(messages, ensure_ascii=False)
+        summary = json.dumps(summary_state or {}, ensure_ascii=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chat_sessions (user, sid, messages, summary, updated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (user, sid, body, summary, time.time()),
+            )
+
+    def purge_expired(self) -> int:
+        """retention_sec より前に更新された履歴を削除し、削除件数を返す"""
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "DELETE FROM chat_sessions WHERE updated < ?",
+                (time.time() - self.retention_sec,),
+            )
+        return cur.rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
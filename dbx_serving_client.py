@@ -1,44 +1,261 @@
-from typing import List, Dict
+import atexit
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional
+
+import httpx
 from databricks.sdk import WorkspaceClient
-from openai import OpenAI
+from openai import DefaultHttpxClient, OpenAI
+
+logger = logging.getLogger(__name__)
 
 class DatabricksServingChatClient:
     """
     Databricks OpenAI クライアントで Serving Endpoint を呼ぶクライアント。
     """
-    def __init__(self, workspace_client: WorkspaceClient, endpoint_name: str):
+    def __init__(
+        self,
+        workspace_client: WorkspaceClient,
+        endpoint_name: str,
+        timeout_sec: float = 120.0,
+        max_retries: int = 3,
+        cache_size: int = 128,
+        history_max_messages: int = 12,
+        history_max_chars: int = 8000,
+        token_ttl_sec: float = 600.0,
+    ):
         self.w = workspace_client
         self.endpoint_name = endpoint_name
+        self.timeout_sec = timeout_sec
+
+        # 同一入力 (temperature=0) の応答キャッシュ (LRU)
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[bytes, str]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        # 送信する履歴の上限 (超えた分は要約に畳み込む)
+        self.history_max_messages = history_max_messages
+        self.history_max_chars = history_max_chars
 
-        # Databricks SDKでトークン取得
+        self.max_retries = max_retries
+        self.token_ttl_sec = token_ttl_sec
+        self._base_url = f"{self.w.config.host.rstrip('/')}/serving-endpoints"
+
+        # keep-alive の接続プールをターン間で使い回す (毎回の TCP+TLS ハンドシェイクを避ける)
+        # トークン更新で OpenAI クライアントを作り直しても、このプールは引き継ぐ
+        # (DefaultHttpxClient で SDK 既定の follow_redirects 等はそのまま使う)
+        self._http_client = DefaultHttpxClient(
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        )
+        self._client_lock = threading.Lock()
+        self._refresh_client()
+        atexit.register(self.close)
+
+    def _refresh_client(self) -> None:
+        """Databricks SDK でトークンを取り直し、OpenAI クライアントを差し替える"""
         headers = self.w.config.authenticate()
         if not headers or "Authorization" not in headers:
             raise RuntimeError("Authorization header not available.")
 
-        # "Bearer xxx" → "xxx" にする
-        api_key = headers["Authorization"].replace("Bearer ", "").strip()
+        # "Bearer xxx" → "xxx" にする (先頭の接頭辞のみ除去)
+        api_key = headers["Authorization"].strip().removeprefix("Bearer ").strip()
+
+        self.client = OpenAI(
+            api_key=api_key,
+            base_url=self._base_url,
+            timeout=self.timeout_sec,
+            max_retries=self.max_retries,
+            http_client=self._http_client,
+        )
+        self._api_key_expiry = time.monotonic() + self.token_ttl_sec
 
-        base_url = f"{self.w.config.host.rstrip('/')}/serving-endpoints"
+    def _get_client(self) -> OpenAI:
+        """TTL 切れならトークンを更新してから OpenAI クライアントを返す"""
+        if time.monotonic() > self._api_key_expiry:
+            with self._client_lock:
+                if time.monotonic() > self._api_key_expiry:
+                    self._refresh_client()
+        return self.client
 
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+    def close(self) -> None:
+        """接続プールを閉じる"""
+        self._http_client.close()
 
     def send_chat(
         self,
         messages: List[Dict[str, str]],
         temperature: float,
         max_tokens: int,
+        summary_state: Optional[Dict[str, Any]] = None,
     ) -> str:
-        resp = self.client.chat.completions.create(
+        key = self._cache_key(messages, temperature, max_tokens)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+
+        resp = self._get_client().chat.completions.create(
+            model=self.endpoint_name,
+            messages=self._prune(messages, summary_state),
+            temperature=float(temperature),
+            max_tokens=int(max_tokens),
+        )
+        text = self._extract_text(resp)
+        self._cache_put(key, text)
+        return text
+
+    def send_chat_stream(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        summary_state: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[str]:
+        """stream=True で呼び出し、生成されたテキストを差分ごとに返す"""
+        key = self._cache_key(messages, temperature, max_tokens)
+        cached = self._cache_get(key)
+        if cached is not None:
+            yield cached
+            return
+
+        parts = []
+        # Stop / rerun で途中で打ち切られても with を抜ける時にレスポンスを閉じ、
+        # プールの接続を返却する
+        with self._get_client().chat.completions.create(
             model=self.endpoint_name,
-            messages=messages,
+            messages=self._prune(messages, summary_state),
             temperature=float(temperature),
             max_tokens=int(max_tokens),
+            stream=True,
+        ) as resp:
+            for chunk in resp:
+                # usage のみのチャンクなど choices が空のものは読み飛ばす
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        # 最後まで受信できた場合のみキャッシュする
+        self._cache_put(key, "".join(parts))
+
+    def _prune(
+        self,
+        messages: List[Dict[str, str]],
+        summary_state: Optional[Dict[str, Any]] = None,
+    ) -> List[Dict[str, str]]:
+        """
+        履歴が history_max_chars を超えたら、古いやり取りを要約して system に畳み込む。
+        直近 history_max_messages 件以上は常にそのまま送り、それより前を
+        history_max_messages 件単位のブロックで畳み込む。
+
+        summary_state ({"cut": 畳み込み済みの件数, "summary": 要約}) は会話ごとに呼び出し側が
+        保持する。cut が次のブロックに進んだ時だけ「前回の要約 + 新しいブロック」で
+        要約を1回更新するので、毎ターン要約を作り直すことはない。
+        省略した場合はその場で全ブロックを要約する。
+        """
+        limit = self.history_max_messages
+        body = [m for m in messages if m["role"] != "system"]
+        if limit <= 0 or sum(len(m["content"]) for m in messages) <= self.history_max_chars:
+            return messages
+        cut = (len(body) - limit) // limit * limit
+        if cut <= 0:
+            return messages
+
+        if summary_state is None:
+            summary_state = {}
+        # 履歴がクリアされた・ブロック幅が変わった場合は作り直す
+        if summary_state.get("cut", 0) > cut or summary_state.get("cut", 0) % limit:
+            summary_state.clear()
+        done = summary_state.get("cut", 0)
+        summary = summary_state.get("summary", "")
+        while done < cut:
+            summary = self._summarize(summary, body[done:done + limit])
+            done += limit
+            summary_state.update(cut=done, summary=summary)
+
+        system = [m for m in messages if m["role"] == "system"]
+        note = f"Summary of the earlier conversation:\n{summary}"
+        if system:
+            head = {"role": "system", "content": f"{system[0]['content']}\n\n{note}"}
+        else:
+            head = {"role": "system", "content": note}
+        return [head] + body[cut:]
+
+    def _summarize(self, summary: str, messages: List[Dict[str, str]]) -> str:
+        """前回までの要約に1ブロック分のやり取りを反映した要約を返す"""
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        # 1ブロック自体が巨大な場合に備え、要約へ渡す量にも上限を設ける
+        transcript = transcript[: self.history_max_chars]
+        if summary:
+            content = f"Summary so far:\n{summary}\n\nNew messages:\n{transcript}"
+        else:
+            content = transcript
+        # 要約は summary_state に保持するので、応答キャッシュは通さない
+        resp = self._get_client().chat.completions.create(
+            model=self.endpoint_name,
+            messages=[
+                {
+                    "role": "system",
+                    "content": (
+                        "Summarize the following dialogue in <=300 tokens. "
+                        "If a summary so far is given, extend it with the new messages."
+                    ),
+                },
+                {"role": "user", "content": content},
+            ],
+            temperature=0.0,
+            max_tokens=400,
         )
         return self._extract_text(resp)
 
+    def _cache_key(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+    ) -> Optional[bytes]:
+        """入力全体のハッシュをキーにする。temperature > 0 は非決定的なのでキャッシュしない"""
+        if self.cache_size <= 0 or float(temperature) > 0:
+            return None
+        raw = json.dumps(
+            [self.endpoint_name, messages, float(temperature), int(max_tokens)],
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).digest()
+
+    def _cache_get(self, key: Optional[bytes]) -> Optional[str]:
+        if key is None:
+            return None
+        with self._cache_lock:
+            text = self._cache.get(key)
+            if text is not None:
+                self._cache.move_to_end(key)
+            return text
+
+    def _cache_put(self, key: Optional[bytes], text: str) -> None:
+        if key is None or not text:
+            return
+        with self._cache_lock:
+            self._cache[key] = text
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
     def _extract_text(self, resp) -> str:
         """OpenAI互換レスポンスからテキストを取り出す"""
-        try:
-            return resp.choices[0].message.content
-        except Exception as e:
-            raise ValueError(f"Unexpected response format: {resp}") from e
+        choices = getattr(resp, "choices", None)
+        if choices:
+            message = getattr(choices[0], "message", None)
+            content = getattr(message, "content", None)
+            if content is not None:
+                return content
+
+        # レスポンス全体の文字列化は重いので、先頭だけを debug ログに出す
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Unexpected response format: %s", repr(resp)[:512])
+        raise ValueError("Unexpected response format")
@@ -0,0 +1,257 @@
+from types import SimpleNamespace
+
+import pytest
+
+import dbx_serving_client
+from chat_history_store import ChatHistoryStore
+from dbx_serving_client import DatabricksServingChatClient
+
+
+class FakeStream:
+    """stream=True の応答。with を抜けたら closed になる"""
+    def __init__(self, parts):
+        self.parts = parts
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.closed = True
+
+    def __iter__(self):
+        for part in self.parts:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=part))])
+
+
+class FakeCompletions:
+    """chat.completions.create の呼び出しを記録し、呼び出し順に番号付きの応答を返す"""
+    def __init__(self):
+        self.calls = []
+        self.streams = []
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        content = f"summary-{len(self.calls)}"
+        if kwargs.get("stream"):
+            stream = FakeStream([content[:4], content[4:]])
+            self.streams.append(stream)
+            return stream
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+@pytest.fixture
+def completions(monkeypatch):
+    fake = FakeCompletions()
+    monkeypatch.setattr(
+        dbx_serving_client,
+        "OpenAI",
+        lambda **kwargs: SimpleNamespace(chat=SimpleNamespace(completions=fake)),
+    )
+    return fake
+
+
+@pytest.fixture
+def make_client(completions):
+    clients = []
+
+    def factory(**kwargs):
+        w = SimpleNamespace(
+            config=SimpleNamespace(
+                host="https://example.cloud.databricks.com/",
+                authenticate=lambda: {"Authorization": "Bearer token"},
+            )
+        )
+        kwargs.setdefault("history_max_messages", 12)
+        kwargs.setdefault("history_max_chars", 8000)
+        c = DatabricksServingChatClient(w, "endpoint", **kwargs)
+        clients.append(c)
+        return c
+
+    yield factory
+    for c in clients:
+        c.close()
+
+
+@pytest.fixture
+def client(make_client):
+    return make_client()
+
+
+def make_history(n, size=1000):
+    body = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"{i:04d}".ljust(size, "x")}
+        for i in range(n)
+    ]
+    return [{"role": "system", "content": "You are a helpful assistant."}] + body
+
+
+def test_prune_keeps_history_under_char_limit(client, completions):
+    messages = make_history(30, size=10)
+    assert client._prune(messages) is messages
+    assert completions.calls == []
+
+
+def test_prune_keeps_short_history_over_char_limit(client, completions):
+    messages = make_history(12, size=2000)
+    assert client._prune(messages) is messages
+    assert completions.calls == []
+
+
+@pytest.mark.parametrize("n", [13, 23])
+def test_prune_keeps_tail_until_a_whole_block_can_be_folded(client, completions, n):
+    messages = make_history(n)
+    assert client._prune(messages) is messages
+    assert completions.calls == []
+
+
+@pytest.mark.parametrize(
+    "n, kept, summary_calls",
+    [(24, 12, 1), (35, 23, 1), (36, 12, 2), (48, 12, 3)],
+)
+def test_prune_folds_old_blocks_once_over_char_limit(client, completions, n, kept, summary_calls):
+    messages = make_history(n)
+    pruned = client._prune(messages)
+
+    assert pruned[0]["role"] == "system"
+    assert pruned[0]["content"].startswith("You are a helpful assistant.")
+    assert f"summary-{summary_calls}" in pruned[0]["content"]
+    assert pruned[1:] == messages[-kept:]
+    assert len(completions.calls) == summary_calls
+
+
+def test_prune_summarizes_incrementally(client, completions):
+    client._prune(make_history(36))
+
+    first, second = (call["messages"][1]["content"] for call in completions.calls)
+    assert first.startswith("user: 0000")
+    # 2ブロック目の要約は前回の要約 + 新しいブロックだけを入力にする
+    assert "summary-1" in second
+    assert "0000" not in second and "0012" in second
+    assert all(len(call["messages"][1]["content"]) <= 8000 + 100 for call in completions.calls)
+
+
+@pytest.mark.parametrize("cache_size", [128, 0])
+def test_prune_extends_summary_state_one_block_at_a_time(make_client, completions, cache_size):
+    client = make_client(cache_size=cache_size)
+    state = {}
+
+    client._prune(make_history(24), state)
+    assert state == {"cut": 12, "summary": "summary-1"}
+
+    # ブロック境界を越えない間は要約を呼ばない
+    for n in range(25, 36):
+        client._prune(make_history(n), state)
+    assert len(completions.calls) == 1
+
+    pruned = client._prune(make_history(36), state)
+    assert state == {"cut": 24, "summary": "summary-2"}
+    assert len(completions.calls) == 2
+    assert "summary-2" in pruned[0]["content"]
+    assert completions.calls[1]["messages"][1]["content"].startswith("Summary so far:\nsummary-1")
+
+
+def test_prune_rebuilds_summary_state_after_history_shrinks(client, completions):
+    state = {"cut": 36, "summary": "stale"}
+    pruned = client._prune(make_history(24), state)
+
+    assert state == {"cut": 12, "summary": "summary-1"}
+    assert "stale" not in pruned[0]["content"]
+
+
+def test_send_chat_caches_only_deterministic_replies(client, completions):
+    messages = make_history(2, size=10)
+
+    assert client.send_chat(messages, 0.0, 64) == client.send_chat(messages, 0.0, 64)
+    assert len(completions.calls) == 1
+
+    client.send_chat(messages, 0.5, 64)
+    client.send_chat(messages, 0.5, 64)
+    assert len(completions.calls) == 3
+
+
+def test_send_chat_evicts_least_recently_used_reply(make_client, completions):
+    client = make_client(cache_size=2)
+    a, b, c = (make_history(n, size=10) for n in (1, 2, 3))
+
+    client.send_chat(a, 0.0, 64)
+    client.send_chat(b, 0.0, 64)
+    client.send_chat(a, 0.0, 64)  # a を最近使ったことにする
+    client.send_chat(c, 0.0, 64)  # b が追い出される
+    assert len(completions.calls) == 3
+
+    client.send_chat(a, 0.0, 64)
+    assert len(completions.calls) == 3
+    client.send_chat(b, 0.0, 64)
+    assert len(completions.calls) == 4
+
+
+def test_send_chat_stream_caches_only_completed_replies(client, completions):
+    messages = make_history(2, size=10)
+
+    # 途中で閉じたストリームは閉じられ、キャッシュされない
+    stream = client.send_chat_stream(messages, 0.0, 64)
+    next(stream)
+    stream.close()
+    assert completions.streams[0].closed
+    assert len(client._cache) == 0
+
+    reply = "".join(client.send_chat_stream(messages, 0.0, 64))
+    assert reply == "summary-2"
+    assert client.send_chat(messages, 0.0, 64) == "summary-2"
+    assert list(client.send_chat_stream(messages, 0.0, 64)) == ["summary-2"]
+    assert len(completions.calls) == 2
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = ChatHistoryStore(str(tmp_path / "chat.db"))
+    yield s
+    s.close()
+
+
+def test_store_round_trip_and_overwrite(store):
+    assert store.load("alice@example.com", "sid1") is None
+
+    first = [{"role": "system", "content": "sys"}, {"role": "user", "content": "こんにちは"}]
+    store.save("alice@example.com", "sid1", first)
+    assert store.load("alice@example.com", "sid1") == first
+
+    second = first + [{"role": "assistant", "content": "hi"}]
+    store.save("alice@example.com", "sid1", second)
+    assert store.load("alice@example.com", "sid1") == second
+
+
+def test_store_scopes_sessions_by_user(store):
+    store.save("alice@example.com", "sid1", [{"role": "user", "content": "secret"}])
+
+    # 同じ sid でも別ユーザーからは読めず、保存しても上書きされない
+    assert store.load("bob@example.com", "sid1") is None
+    store.save("bob@example.com", "sid1", [{"role": "user", "content": "bob"}])
+    assert store.load("alice@example.com", "sid1") == [{"role": "user", "content": "secret"}]
+
+
+def test_store_round_trips_summary_state(store):
+    messages = [{"role": "user", "content": "hi"}]
+    store.save("alice@example.com", "sid1", messages)
+    assert store.load_summary("alice@example.com", "sid1") == {}
+
+    store.save("alice@example.com", "sid1", messages, {"cut": 12, "summary": "要約"})
+    assert store.load_summary("alice@example.com", "sid1") == {"cut": 12, "summary": "要約"}
+    assert store.load_summary("bob@example.com", "sid1") is None
+
+
+def test_store_expires_old_sessions(tmp_path, monkeypatch):
+    import chat_history_store
+
+    now = 1_000_000.0
+    monkeypatch.setattr(chat_history_store.time, "time", lambda: now)
+    s = ChatHistoryStore(str(tmp_path / "chat.db"), retention_sec=60)
+    s.save("alice@example.com", "old", [{"role": "user", "content": "old"}])
+
+    now += 61
+    s.save("alice@example.com", "new", [{"role": "user", "content": "new"}])
+    assert s.load("alice@example.com", "old") is None
+    assert s.purge_expired() == 1
+    assert s.load("alice@example.com", "new") == [{"role": "user", "content": "new"}]
+    s.close()